@@ -8,10 +8,11 @@ References:
     https://gitlab.haskell.org/ghc/ghc/wikis/commentary/rts/storage/heap-objects
 """
 
-from __future__ import print_function
-
-if sys.version_info.major == 2:
-    range = xrange
+import collections
+import functools
+import re
+import struct
+import sys
 
 # Common types
 StgClosure_p = gdb.lookup_type("StgClosure").pointer()
@@ -21,8 +22,65 @@ StgRetInfoTable_p = gdb.lookup_type("StgRetInfoTable").pointer()
 StgTSO_p = gdb.lookup_type("StgTSO").pointer()
 StgWord_p = gdb.lookup_type('StgWord').pointer()
 
+# Sizes in bytes and words
+WORD_SIZE = StgWord_p.target().sizeof
+STGRETFUN_WORDS = StgRetFun_p.target().sizeof // WORD_SIZE
+
+# Stack words are decoded from raw memory (64-bit little endian only).
+unpack_word = struct.Struct('<Q').unpack_from
+unpack_halfword = struct.Struct('<I').unpack_from
+
 # Assumes TABLES_NEXT_TO_CODE
 
+# Caches
+#
+# Lookups through gdb are expensive, so their results are memoized.
+# Every cache registers its clear function in one of two lists:
+#
+# - _STOP_CACHES hold inferior state (RTS globals) and are dropped
+#   when the inferior resumes;
+# - _SYMBOL_CACHES hold symbol and info table lookups, which only
+#   depend on loaded code, and are dropped when objfiles change.
+#
+# gdb invokes event handlers and commands from its main thread,
+# so no locking is needed.
+
+_STOP_CACHES = []
+_SYMBOL_CACHES = []
+
+def _memoize(maxsize=65536, caches=_SYMBOL_CACHES):
+    "functools.lru_cache, invalidated with the given caches"
+    def wrap(f):
+        f = functools.lru_cache(maxsize)(f)
+        caches.append(f.cache_clear)
+        return f
+    return wrap
+
+def _clear_stop_caches(_evt):
+    for clear in _STOP_CACHES:
+        clear()
+
+def _clear_symbol_caches(_evt):
+    _clear_stop_caches(_evt)
+    for clear in _SYMBOL_CACHES:
+        clear()
+
+gdb.events.cont.connect(_clear_stop_caches)
+for _name in ("new_objfile", "free_objfile", "clear_objfiles"):
+    # free_objfile needs gdb >= 13
+    if hasattr(gdb.events, _name):
+        getattr(gdb.events, _name).connect(_clear_symbol_caches)
+
+# Evaluation of RTS globals.
+
+@_memoize(None, _STOP_CACHES)
+def _peval(expr):
+    return gdb.parse_and_eval(expr)
+
+@_memoize(None, _STOP_CACHES)
+def _end_tso():
+    return int(_peval('&stg_END_TSO_QUEUE_closure'))
+
 class InfoTsos(gdb.Command):
     "List all TSOs"
 
@@ -51,49 +109,55 @@ class InfoTsoProfile(gdb.Command):
         args = argstr.split()
         uniq = "-u" in args
         verbose = "-v" in args
+        write = sys.stdout.write
         for t in running_tsos():
             try:
-                stack = []
+                # frames are walked from the top of the stack
+                stack = collections.deque()
                 prev = None
                 for obj in t.walk_stack():
+                    if not verbose and obj.skipped():
+                        continue
                     f = obj.cached_funcname()
-                    if not verbose:
-                        if f == "??" or f.startswith("stg_"):
-                            # skip
-                            continue
                     if uniq and f == prev:
                         continue
-                    stack.append(f)
+                    stack.appendleft(f)
                     prev = f
-                stack.reverse()
-                print("PROFILE;" + ";".join(stack))
+                write("PROFILE;")
+                write(";".join(stack))
+                write("\n")
             except gdb.MemoryError as err:
                 print("error:", err)
 
 def all_tsos():
     # See rts/Threads.c:printAllThreads
-    n_caps = gdb.parse_and_eval('n_capabilities')
-    caps = gdb.parse_and_eval('capabilities')
-    n_gcgens = gdb.parse_and_eval('RtsFlags.GcFlags.generations')
-    gcgens = gdb.parse_and_eval('generations')
+    n_caps = _peval('n_capabilities')
+    caps = _peval('capabilities')
+    n_gcgens = _peval('RtsFlags.GcFlags.generations')
+    gcgens = _peval('generations')
+
+    end = _end_tso()
 
+    # Compare raw pointers to avoid reading the end of queue sentinel.
     for i in range(n_caps):
         cap = (caps + i).dereference()
-        t = TSO(cap['run_queue_hd'])
-        while t is not None and not t.is_end():
+        p = cap['run_queue_hd']
+        while int(p) != end:
+            t = TSO(p)
             yield t
-            t = t.link()
+            p = t.tso['_link']
 
     for i in range(n_gcgens):
         g = (gcgens + i).dereference()
-        t = TSO(g['threads'])
-        while t is not None and not t.is_end():
+        p = g['threads']
+        while int(p) != end:
+            t = TSO(p)
             yield t
-            t = t.global_link()
+            p = t.tso['global_link']
 
 def running_tsos():
-    n_caps = gdb.parse_and_eval('n_capabilities')
-    caps = gdb.parse_and_eval('capabilities')
+    n_caps = _peval('n_capabilities')
+    caps = _peval('capabilities')
 
     for i in range(n_caps):
         cap = (caps + i).dereference()
@@ -112,8 +176,7 @@ class TSO:
         return self.tso.address
 
     def is_end(self):
-        end = gdb.parse_and_eval('&stg_END_TSO_QUEUE_closure').cast(StgTSO_p)
-        return self.addr() == end
+        return int(self.addr()) == _end_tso()
 
     def link(self):
         l = self.tso["_link"]
@@ -149,14 +212,17 @@ class TSO:
     def walk_stack(self):
         # see rts/Printer.c:printTSO
         stack = self.tso['stackobj'].dereference()
-        sp = stack['sp']
-        base = stack['stack'].cast(StgWord_p)
-        top = base + int(stack['stack_size'])
+        sp = int(stack['sp'])
+        base = int(stack['stack'].cast(StgWord_p))
+        top = base + int(stack['stack_size']) * WORD_SIZE
         #print("    stack", sp, "->", top)
-        while int(sp) < int(top):
-            obj = Closure(sp)
+        # Read the whole stack at once rather than word by word.
+        buf = gdb.selected_inferior().read_memory(sp, top - sp).tobytes()
+        off, end = 0, len(buf)
+        while off < end:
+            obj = Closure(buf, off, sp + off)
             yield obj
-            sp += obj.frame_size()
+            off += obj.frame_size() * WORD_SIZE
 
     # from rts/Constants.h
     ThreadRunGHC = 1
@@ -195,17 +261,51 @@ class TSO:
     }
 
 # Helpers to extract function names.
+#
+# Symbol lookups are memoized per PC: stacks of different TSOs
+# usually share many return addresses.
 
+@_memoize()
+def _block_for_pc(pc):
+    try:
+        return gdb.block_for_pc(pc)
+    except Exception:
+        return None
+
+@_memoize()
+def _pc_line(pc):
+    "Returns (filename, line) for pc, filename being None if unknown"
+    sym = gdb.find_pc_line(pc)
+    return (sym.symtab.filename if sym.symtab else None, sym.line)
+
+@_memoize()
 def pc_funcname(pc):
+    # Prefer the symbol table, the CLI is only needed for minimal
+    # symbols (info tables usually have no debug information).
+    block = _block_for_pc(pc)
+    if block is not None and block.function:
+        return block.function.linkage_name
+    if not _in_objfile(pc):
+        # e.g. JIT code or an unmapped address
+        return None
     try:
-        func = gdb.execute("info symbol 0x%x" % pc, to_string=True)
+        out = gdb.execute("info symbol 0x%x" % pc, to_string=True)
     except Exception:
         return None
+    # Output looks like "sym_info + 16 in section .text"
+    func = out.split(" ", 1)[0]
     if "_info" in func:
-        func, _, _ = func.partition(" ")
         return func
     return None
 
+def _in_objfile(pc):
+    "Whether pc belongs to a known object file (True if unsure)"
+    progspace = gdb.current_progspace()
+    if not hasattr(progspace, "objfile_for_address"):
+        # gdb < 13
+        return True
+    return progspace.objfile_for_address(pc) is not None
+
 def block_funcname(b):
     if b.function:
         return str(b.function)
@@ -223,25 +323,32 @@ def guess_funcname(pc):
     sym = gdb.find_pc_line(pc)
     if not sym.symtab:
         return None
-    pcline = sym.line
-    line = 0
-    f = None
-    for l in sym.symtab.linetable():
-        if l.line > pcline:
+    # Relative file names may be shared by several packages.
+    fullname = sym.symtab.fullname()
+    _symtabs[fullname] = sym.symtab
+    return _guess_for_line(fullname, sym.line)
+
+# Symtabs by full file name, for _guess_for_line.
+_symtabs = {}
+_SYMBOL_CACHES.append(_symtabs.clear)
+
+@_memoize()
+def _guess_for_line(fullname, pcline):
+    # Try preceding lines, closest first, until a block is found.
+    linetable = _symtabs[fullname].linetable()
+    lines = [l for l in linetable if 0 < l.line <= pcline]
+    lines.sort(key=lambda l: l.line, reverse=True)
+    for l in lines:
+        b = _block_for_pc(l.pc)
+        s = b.function if b is not None else None
+        if s is None:
             continue
-        if l.line > line:
-            try:
-                s = gdb.block_for_pc(l.pc).function
-            except Exception:
-                s = None
-            if s is None:
-                continue
-            if "zm" in s.name and "zi" in s.name and "_" in s.name:
-                # looks like an ordinary function from a package
-                line = l.line
-                f = s.name
-    return f
+        if "zm" in s.name and "zi" in s.name and "_" in s.name:
+            # looks like an ordinary function from a package
+            return s.name
+    return None
 
+@functools.lru_cache(maxsize=65536)
 def clean_funcname(f):
     """
     Decodes and strips symbol name from any GHC decorations
@@ -255,6 +362,7 @@ def clean_funcname(f):
         f = f[:-len("_info")]
     return f
 
+@functools.lru_cache(maxsize=65536)
 def pretty_funcname(f):
     """
     >>> pretty_funcname("aesonzm1zi4zi6zi0zmI0PKQM6ADfIKvzzTI4BNoug_DataziAttoparsecziTime_zdwf_info")
@@ -271,107 +379,135 @@ def pretty_funcname(f):
         return pkg + ":" + f
     return f
 
+@_memoize()
+def _funcname_for_pc(pc, pretty):
+    "Resolves the name of the function a return address belongs to"
+    clean = pretty_funcname if pretty else clean_funcname
+
+    block = _block_for_pc(pc)
+    if block is not None:
+        func = block_funcname(block)
+        if func:
+            return clean(func)
+
+    # Try a parent block
+    closure = False
+    while block and block.superblock:
+        block = block.superblock
+        closure = True
+        func = block_funcname(block)
+        if func:
+            return clean(func) + ":closure"
+
+    func = pc_funcname(pc)
+    if func:
+        func = clean(func)
+        if closure:
+            func += ":closure"
+        return func
+
+    # Try heuristics
+    if pretty and func is None:
+        func = guess_funcname(pc)
+        if func:
+            func = clean(func)
+            return func + ":??"
+
+    return "??"
+
+def _field_offset(t, name):
+    "Returns the byte offset of a field of struct type t"
+    for f in t.fields():
+        if f.name == name:
+            return f.bitpos // 8
+    raise KeyError(name)
+
+# Layout of return info tables, to decode them from raw memory.
+RETINFO_SIZE = StgRetInfoTable_p.target().sizeof
+_off_i = _field_offset(StgRetInfoTable_p.target(), 'i')
+RETINFO_TYPE_OFF = _off_i + _field_offset(StgInfoTable_p.target(), 'type')
+RETINFO_BITMAP_OFF = _off_i + _field_offset(StgInfoTable_p.target(), 'layout')
+
+@_memoize()
+def _retinfo_for(info_ptr):
+    """
+    Returns the (type, bitmap) pair of the return info table
+    for a given info pointer.
+    """
+    buf = gdb.selected_inferior().read_memory(
+        info_ptr - RETINFO_SIZE, RETINFO_SIZE).tobytes()
+    typ = unpack_halfword(buf, RETINFO_TYPE_OFF)[0]
+    bitmap = unpack_word(buf, RETINFO_BITMAP_OFF)[0]
+    return typ, bitmap
+
 class Closure:
-    "A StgClosure generic heap object"
-    def __init__(self, p):
-        self.obj = p.cast(StgClosure_p).dereference()
+    "A stack frame, read from a raw copy of the stack"
+    def __init__(self, buf, offset, addr):
+        self.buf = buf
+        self.offset = offset
+        self.addr = addr
 
     def frame_size(self):
         # see stack_frame_sizeW()
-        retinfo = self.retinfo()
-        ctyp = retinfo['i']['type']
+        ctyp, bitmap = _retinfo_for(self.pc())
         if ctyp == Closure.RET_FUN:
-            size = self.obj.cast(StgRetFun_p).dereference()['size']
-            return StgRetFun_p.target().sizeof // StgRetFun_p.sizeof + size
+            p = gdb.Value(self.addr).cast(StgRetFun_p)
+            size = int(p.dereference()['size'])
+            return STGRETFUN_WORDS + size
         elif ctyp == Closure.RET_BIG:
             raise NotImplementedError("barf")
         elif ctyp == Closure.RET_BCO:
             raise NotImplementedError("barf")
         else:
             # for 64-bit only
-            return 1 + (retinfo['i']['layout']['bitmap'] & 0x3f)
+            return 1 + (bitmap & 0x3f)
 
     def info(self):
-        info = self.obj['header']['info']
-        p = info.cast(StgInfoTable_p) - 1
+        p = gdb.Value(self.pc()).cast(StgInfoTable_p) - 1
         return p.dereference()
 
     def retinfo(self):
-        info = self.obj['header']['info']
-        p = info.cast(StgRetInfoTable_p) - 1
+        p = gdb.Value(self.pc()).cast(StgRetInfoTable_p) - 1
         return p.dereference()
 
     def pc(self):
-        p = self.obj.address.cast(StgWord_p)
-        return int(p.dereference())
+        return unpack_word(self.buf, self.offset)[0]
 
     def lineno(self):
-        sym = gdb.find_pc_line(self.pc())
-        return "{}:{}".format(
-            sym.symtab.filename if sym.symtab else '?', sym.line)
+        filename, line = _pc_line(self.pc())
+        return "{}:{}".format(filename or '?', line)
 
-    funcname_cache = {}
+    def cached_funcname(self, pretty=True):
+        return _funcname_for_pc(self.pc(), pretty)
 
-    def cached_funcname(self):
-        pc = self.pc()
-        if pc not in self.funcname_cache:
-            f = self.funcname(pretty=True)
-            self.funcname_cache[pc] = f
-        else:
-            f = self.funcname_cache[pc]
-        return f
-
-    def funcname(self, pretty=False):
-        clean = pretty_funcname if pretty else clean_funcname
+    skip_cache = {}
 
+    def skipped(self):
+        "Whether the frame is omitted from non-verbose profiles"
         pc = self.pc()
-        try:
-            block = gdb.block_for_pc(pc)
-        except Exception:
-            block = None
-        if block is not None:
-            func = block_funcname(block)
-            if func:
-                return clean(func)
-
-        # Try a parent block
-        closure = False
-        while block and block.superblock:
-            block = block.superblock
-            closure = True
-            func = block_funcname(block)
-            if func:
-                return clean(func) + ":closure"
-
-        func = pc_funcname(pc)
-        if func:
-            func = clean(func)
-            if closure:
-                func += ":closure"
-            return func
+        skip = self.skip_cache.get(pc)
+        if skip is None:
+            f = self.cached_funcname()
+            skip = f == "??" or f.startswith("stg_")
+            self.skip_cache[pc] = skip
+        return skip
 
-        # Try heuristics
-        if pretty and func is None:
-            func = guess_funcname(pc)
-            if func:
-                func = clean(func)
-                return func + ":??"
-
-        return "??"
+    def funcname(self, pretty=False):
+        return _funcname_for_pc(self.pc(), pretty)
 
     def print_frame(self, compact=False):
         info = self.info()
         typ = int(info['type'])
-        func = self.funcname(pretty=compact)
+        func = self.cached_funcname(pretty=compact)
         if not func:
-            func = str(self.info()['code'].address)
+            func = str(info['code'].address)
 
         pc = self.pc()
         if compact:
-            sym = gdb.find_pc_line(pc)
-            if sym.symtab:
+            filename, line = _pc_line(pc)
+            if filename:
                 print("  0x{:016x} in {} at {}:{}".format(
-                    pc, func, sym.symtab.filename, sym.line))
+                    pc, func, filename, line))
             else:
                 print("  0x{:016x} in {}".format(pc, func))
         else:
@@ -396,6 +532,8 @@ class Closure:
         ATOMICALLY_FRAME: "atomically",
     }
 
+_SYMBOL_CACHES.append(Closure.skip_cache.clear)
+
 def zdecode(s):
     """
     See https://gitlab.haskell.org/ghc/ghc/-/wikis/commentary/compiler/symbol-names
@@ -404,25 +542,19 @@ def zdecode(s):
     'base_Text.ParserCombinators.ReadP_$fAlternativeP_$c<|>_info'
     >>> zdecode("timezm1zi9zi3_DataziTimeziLocalTimeziInternalziTimeZZone_TimeZZone_con_info")
     'time-1.9.3_Data.Time.LocalTime.Internal.TimeZone_TimeZone_con_info'
+    >>> zdecode("stg_upd_frame_info")
+    'stg_upd_frame_info'
     """
-    res = ""
-    while s:
-        idx_z = s.find("z")
-        idx_Z = s.find("Z")
-        if idx_z < 0 and idx_Z < 0:
-            res += s
-            return res
-        elif idx_z < 0:
-            idx = idx_Z
-        elif idx_Z < 0:
-            idx = idx_z
-        else:
-            idx = min(idx_z, idx_Z)
-        res += s[:idx]
-        tok = s[idx:idx+2]
-        s = s[idx+2:]
-        res += ztrans.get(tok, tok)
-    return res
+    if 'z' not in s and 'Z' not in s:
+        return s
+    return _zsub(_ztoken, s)
+
+# A z-encoded token is z or Z followed by one character.
+_zsub = re.compile(r'[zZ].?', re.S).sub
+
+def _ztoken(m):
+    tok = m.group(0)
+    return ztrans.get(tok, tok)
 
 ztrans = {
     "ZC": "ZC",